@@ -1,7 +1,10 @@
 import argparse
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
 from dotenv import load_dotenv
-from bs4 import BeautifulSoup, element as BeautifulSoupElement
+from bs4 import BeautifulSoup, SoupStrainer
+import hashlib
 import json
 from markdownify import markdownify
 import openai
@@ -30,9 +33,59 @@ MD_DIR = BUILD_DIR / "md"
 
 POSTGRES_BASE_URL = "https://www.postgresql.org/docs"
 
+# Skip files which are more metadata about the docs than actual docs that
+# people would ask questions about.
+SKIP_FILES = frozenset(
+    {
+        "legalnotice.html",
+        "appendix-obsolete.md",
+        "appendixes.md",
+        "biblio.html",
+        "bookindex.html",
+        "bug-reporting.html",
+        "source-format.html",
+        "error-message-reporting.html",
+        "error-style-guide.html",
+        "source-conventions.html",
+        "sourcerepo.html",
+    }
+)
+
+# Only the title and the top-level content divs of a docs page are needed.
+# Tags rejected by a strainer are never built, so the navigation header and
+# footer are skipped while parsing rather than decomposed afterwards.
+NAV_CLASSES = ("navheader", "navfooter")
+CONTENT_STRAINER = SoupStrainer(["title", "div"], class_=lambda c: c not in NAV_CLASSES)
+
+ADMONITION_CLASSES = frozenset(
+    {"caution", "important", "notice", "warning", "tip", "note"}
+)
+
+HEADER_RE = re.compile("^(#{1,3}) .+$")
+SECTION_RE = re.compile(r"^[A-Za-z0-9.]+\.\s*")
+CHAPTER_RE = re.compile(r"^Chapter\s+[0-9]+\.\s*")
+URL_ANCHOR_RE = re.compile(r"\((#\S+)\)")
+
 ENC = tiktoken.get_encoding("cl100k_base")
 MAX_CHUNK_TOKENS = 7000
 
+# Token ids of recently encoded chunk contents, keyed by a digest of the
+# content, in least to most recently used order.
+TOKEN_CACHE: OrderedDict[bytes, list[int]] = OrderedDict()
+TOKEN_CACHE_SIZE = 4096
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Must match the docs.postgres_chunks embedding column and the query
+# embeddings generated by the search API.
+EMBEDDING_DIMENSIONS = 1536
+EMBEDDING_BATCH_SIZE = 128
+# The embeddings endpoint rejects requests whose inputs total more than 300k
+# tokens, so leave some headroom below that.
+EMBEDDING_BATCH_TOKENS = 250_000
+EMBEDDING_WORKERS = 8
+
+OPENAI_CLIENT = openai.OpenAI(api_key=OPENAI_API_KEY)
+
 
 def update_repo():
     if not POSTGRES_DIR.exists():
@@ -136,86 +189,66 @@ def build_html() -> None:
     )
 
 
-def build_markdown() -> None:
-    print("converting to markdown...")
-    if MD_DIR.exists():
-        shutil.rmtree(MD_DIR)
-    MD_DIR.mkdir()
-
-    for html_file in HTML_DIR.glob("*.html"):
-        # Skip files which are more metadata about the docs than actual docs
-        # that people would ask questions about.
-        if html_file.name in [
-            "legalnotice.html",
-            "appendix-obsolete.md",
-            "appendixes.md",
-            "biblio.html",
-            "bookindex.html",
-            "bug-reporting.html",
-            "source-format.html",
-            "error-message-reporting.html",
-            "error-style-guide.html",
-            "source-conventions.html",
-            "sourcerepo.html",
-        ] or html_file.name.startswith("docguide"):
-            continue
-        md_file = MD_DIR / (html_file.stem + ".md")
+def build_markdown_file(html_file: Path) -> None:
+    md_file = MD_DIR / (html_file.stem + ".md")
 
-        html_content = html_file.read_text(encoding="utf-8")
-        html_content = html_content.replace(
-            '<?xml version="1.0" encoding="UTF-8" standalone="no"?>', ""
-        )
+    html_content = html_file.read_text(encoding="utf-8")
+    html_content = html_content.replace(
+        '<?xml version="1.0" encoding="UTF-8" standalone="no"?>', ""
+    )
 
-        soup = BeautifulSoup(html_content, "html.parser")
+    soup = BeautifulSoup(html_content, "lxml", parse_only=CONTENT_STRAINER)
 
-        is_refentry = bool(soup.find("div", class_="refentry"))
+    is_refentry = bool(soup.find("div", class_="refentry"))
 
-        elem = soup.find("div", attrs={"id": True})
-        if elem and isinstance(elem, BeautifulSoupElement.Tag):
-            slug = str(elem["id"]).lower() + ".html"
-        else:
-            raise SystemError(f"No div with id found in {html_file}")
+    elem = soup.find("div", attrs={"id": True})
+    if elem is None:
+        raise SystemError(f"No div with id found in {html_file}")
+    slug = elem["id"].lower() + ".html"
 
-        title = soup.find("title")
-        title_text = (
-            str(title.string).strip()
-            if title and isinstance(title, BeautifulSoupElement.Tag)
-            else "PostgreSQL Documentation"
-        )
-        if title:
-            title.decompose()
-        for class_name in ["navheader", "navfooter"]:
-            for div in soup.find_all("div", class_=class_name):
-                div.decompose()
-
-        # Don't bother including refentry in the transform as we don't chunk
-        # them by headers anyway.
-        if not is_refentry:
-            # Convert h3 headings in admonitions to h4 so that we avoid
-            # chunking them.
-            for class_name in [
-                "caution",
-                "important",
-                "notice",
-                "warning",
-                "tip",
-                "note",
-            ]:
-                for div in soup.find_all("div", class_=class_name):
-                    if div is None or not isinstance(div, BeautifulSoupElement.Tag):
-                        continue
-                    h3 = div.find("h3")
-                    if h3 and isinstance(h3, BeautifulSoupElement.Tag):
-                        h3.name = "h4"
-
-        md_content = markdownify(str(soup), heading_style="ATX")
-        md_content = f"""---
+    title = soup.find("title")
+    if title:
+        title_text = title.get_text().strip()
+        title.decompose()
+    else:
+        title_text = "PostgreSQL Documentation"
+
+    # Don't bother including refentry in the transform as we don't chunk
+    # them by headers anyway.
+    if not is_refentry:
+        # Convert h3 headings in admonitions to h4 so that we avoid
+        # chunking them.
+        for div in soup.find_all("div", class_=lambda c: c in ADMONITION_CLASSES):
+            h3 = div.find("h3")
+            if h3:
+                h3.name = "h4"
+
+    md_content = markdownify(str(soup), heading_style="ATX")
+    md_content = f"""---
 title: {title_text}
 slug: {slug}
 refentry: {is_refentry}
 ---
 {md_content}"""
-        md_file.write_text(md_content, encoding="utf-8")
+    md_file.write_text(md_content, encoding="utf-8")
+
+
+def build_markdown() -> None:
+    print("converting to markdown...")
+    if MD_DIR.exists():
+        shutil.rmtree(MD_DIR)
+    MD_DIR.mkdir()
+
+    html_files = []
+    for html_file in HTML_DIR.glob("*.html"):
+        if html_file.name in SKIP_FILES or html_file.name.startswith("docguide"):
+            continue
+        html_files.append(html_file)
+
+    # Each file is converted independently and the work is CPU bound on
+    # parsing, so spread it across processes.
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(build_markdown_file, html_files, chunksize=16))
 
 
 @dataclass
@@ -237,25 +270,26 @@ class Chunk:
     subindex: int = 0
 
 
-def insert_page(
+def insert_pages(
     conn: psycopg.Connection,
-    page: Page,
+    pages: list[Page],
 ) -> None:
-    print("inserting page", page.filename, page.url)
-    result = conn.execute(
-        "insert into docs.postgres_pages_tmp (version, url, domain, filename, content_length, chunks_count) values (%s,%s,%s,%s,%s,%s) RETURNING id",
-        [
-            page.version,
-            page.url,
-            page.domain,
-            page.filename,
-            0,
-            0,
-        ],
-    )
-    row = result.fetchone()
-    assert row is not None
-    page.id = row[0]
+    if not pages:
+        return
+    params = []
+    for page in pages:
+        print("inserting page", page.filename, page.url)
+        params.extend([page.version, page.url, page.domain, page.filename, 0, 0])
+    values = ",".join(["(%s,%s,%s,%s,%s,%s)"] * len(pages))
+    rows = conn.execute(
+        f"insert into docs.postgres_pages_tmp (version, url, domain, filename, content_length, chunks_count) values {values} RETURNING id, url",
+        params,
+    ).fetchall()
+    # RETURNING order is not guaranteed to match VALUES order, so map back on
+    # the unique url.
+    ids = {url: page_id for page_id, url in rows}
+    for page in pages:
+        page.id = ids[page.url]
 
 
 def update_page_stats(
@@ -280,61 +314,76 @@ def update_page_stats(
         where p.id = chunks_stats.page_id and p.id = %s
     """,
         [page.id, page.id],
+        # Run once per page, so prepare it from the first call rather than
+        # waiting for psycopg's automatic prepare threshold.
+        prepare=True,
     )
 
 
-def insert_chunk(
-    conn: psycopg.Connection,
+def build_chunk_row(
     page: Page,
     chunk: Chunk,
-) -> None:
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
-    content = ""
-    for i in range(len(chunk.header_path)):
-        content += (
-            "".join(["#" for _ in range(i + 1)]) + " " + chunk.header_path[i] + "\n\n"
-        )
-    content += chunk.content
-    embedding = (
-        client.embeddings.create(
-            model="text-embedding-3-small",
-            input=chunk.content,
-        )
-        .data[0]
-        .embedding
-    )
-    content = chunk.content
-    # token_count, embedding = embed(header_path, content)
+    embedding: list[float],
+) -> tuple:
     print(f"header: {chunk.header}")
     url = page.url
     if len(chunk.header_path) > 1:
-        pattern = r"\((#\S+)\)"
-        match = re.search(pattern, chunk.header_path[-1])
+        match = URL_ANCHOR_RE.search(chunk.header_path[-1])
         if match:
             url += match.group(1).lower()
-    conn.execute(
-        "insert into docs.postgres_chunks_tmp (page_id, chunk_index, sub_chunk_index, content, metadata, embedding) values (%s,%s,%s,%s,%s,%s)",
-        [
-            page.id,
-            chunk.idx,
-            chunk.subindex,
-            chunk.content,
-            json.dumps(
-                {
-                    "header": chunk.header,
-                    "header_path": chunk.header_path,
-                    "source_url": url,
-                    "token_count": chunk.token_count,
-                }
-            ),
-            embedding,
-        ],
+    return (
+        page.id,
+        chunk.idx,
+        chunk.subindex,
+        chunk.content,
+        json.dumps(
+            {
+                "header": chunk.header,
+                "header_path": chunk.header_path,
+                "source_url": url,
+                "token_count": chunk.token_count,
+            }
+        ),
+        # pgvector's text input format happens to match a JSON array.
+        json.dumps(embedding),
     )
 
 
-def split_chunk(chunk: Chunk) -> list[Chunk]:
+def copy_chunks(conn: psycopg.Connection, rows: list[tuple]) -> None:
+    if not rows:
+        return
+    with (
+        conn.cursor() as cur,
+        cur.copy(
+            "copy docs.postgres_chunks_tmp (page_id, chunk_index, sub_chunk_index, content, metadata, embedding) from stdin"
+        ) as copy,
+    ):
+        for row in rows:
+            copy.write_row(row)
+
+
+def encode_batch(texts: list[str]) -> list[list[int]]:
+    keys = [hashlib.blake2b(text.encode(), digest_size=16).digest() for text in texts]
+    missing = {key: text for key, text in zip(keys, texts) if key not in TOKEN_CACHE}
+    if missing:
+        # Tokenize all cache misses in one call so that tiktoken can spread the
+        # work over its own threads.
+        encoded = ENC.encode_batch(
+            list(missing.values()), num_threads=os.cpu_count() or 1
+        )
+        TOKEN_CACHE.update(zip(missing, encoded))
+
+    result = []
+    for key in keys:
+        TOKEN_CACHE.move_to_end(key)
+        result.append(TOKEN_CACHE[key])
+    while len(TOKEN_CACHE) > TOKEN_CACHE_SIZE:
+        TOKEN_CACHE.popitem(last=False)
+    return result
+
+
+def split_chunk(chunk: Chunk, input_ids: list[int]) -> list[Chunk]:
     num_subchunks = (chunk.token_count // MAX_CHUNK_TOKENS) + 1
-    input_ids = ENC.encode(chunk.content)
 
     tokens_per_chunk = len(input_ids) // num_subchunks
 
@@ -365,25 +414,114 @@ def split_chunk(chunk: Chunk) -> list[Chunk]:
     return subchunks
 
 
-def process_chunk(conn: psycopg.Connection, page: Page, chunk: Chunk) -> None:
-    if chunk.content == "":  # discard empty chunks
-        return
+def batch_chunks(chunks: list[Chunk]) -> list[list[Chunk]]:
+    batches: list[list[Chunk]] = []
+    batch: list[Chunk] = []
+    batch_tokens = 0
+    for chunk in chunks:
+        if batch and (
+            len(batch) >= EMBEDDING_BATCH_SIZE
+            or batch_tokens + chunk.token_count > EMBEDDING_BATCH_TOKENS
+        ):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(chunk)
+        batch_tokens += chunk.token_count
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def embed_chunks(page: Page, chunks: list[Chunk]) -> list[tuple]:
+    response = OPENAI_CLIENT.embeddings.create(
+        model=EMBEDDING_MODEL,
+        input=[chunk.content for chunk in chunks],
+        dimensions=EMBEDDING_DIMENSIONS,
+    )
+    return [
+        build_chunk_row(page, chunk, data.embedding)
+        for chunk, data in zip(chunks, response.data, strict=True)
+    ]
 
-    chunk.token_count = len(ENC.encode(chunk.content))
-    if chunk.token_count < 10:  # discard chunks that are too tiny to be useful
-        return
 
-    chunks = [chunk]
+def save_page(
+    conn: psycopg.Connection,
+    page: Page,
+    embeddings: list[Future[list[tuple]]],
+) -> None:
+    rows = [row for future in embeddings for row in future.result()]
+    copy_chunks(conn, rows)
+    # COPY cannot run in pipeline mode, but the stats update and the commit
+    # that follow it can be sent without waiting on each other.
+    with conn.pipeline():
+        update_page_stats(conn, page)
+        conn.commit()
+
 
-    if chunk.token_count > MAX_CHUNK_TOKENS:
-        print(
-            f"Chunk {chunk.header} too large ({chunk.token_count} tokens), splitting..."
-        )
-        chunks = split_chunk(chunk)
+def process_chunks(chunks: list[Chunk]) -> list[Chunk]:
+    chunks = [chunk for chunk in chunks if chunk.content != ""]  # discard empty chunks
+
+    token_ids = encode_batch([chunk.content for chunk in chunks])
+
+    processed: list[Chunk] = []
+    for chunk, ids in zip(chunks, token_ids, strict=True):
+        chunk.token_count = len(ids)
+        if chunk.token_count < 10:  # discard chunks that are too tiny to be useful
+            continue
+
+        if chunk.token_count > MAX_CHUNK_TOKENS:
+            print(
+                f"Chunk {chunk.header} too large ({chunk.token_count} tokens), splitting..."
+            )
+            processed.extend(split_chunk(chunk, ids))
+        else:
+            processed.append(chunk)
+    return processed
 
-    for chunk in chunks:
-        insert_chunk(conn, page, chunk)
-    conn.commit()
+
+def read_chunks(md: Path, refentry: bool) -> list[Chunk]:
+    # Read the whole file in one go rather than a readline() call per line.
+    with md.open(encoding="utf-8") as f:
+        lines = f.readlines()
+
+    page_chunks: list[Chunk] = []
+    header_path = []
+    idx = 0
+    chunk: Chunk | None = None
+    # Lines of the current chunk, joined once the chunk is complete.
+    content_parts: list[str] = []
+    in_codeblock = False
+    for line in lines[5:]:  # skip the frontmatter
+        match = HEADER_RE.match(line)
+        if match is None or in_codeblock or (refentry and chunk is not None):
+            assert chunk is not None
+            if line.startswith("```"):
+                in_codeblock = not in_codeblock
+            content_parts.append(line)
+            continue
+        header_hases = match.group(1)
+        depth = len(header_hases)
+        header_path = header_path[: (depth - 1)]
+        header = line.lstrip("#").strip()
+        header = SECTION_RE.sub("", header).strip()
+        header = CHAPTER_RE.sub("", header).strip()
+        header_path.append(header)
+        if chunk is not None:
+            chunk.content = "".join(content_parts)
+            page_chunks.append(chunk)
+            content_parts = []
+        chunk = Chunk(
+            idx=idx,
+            header=header,
+            header_path=header_path.copy(),
+            content="",
+        )
+        idx += 1
+    if chunk is not None:
+        chunk.content = "".join(content_parts)
+        page_chunks.append(chunk)
+    return process_chunks(page_chunks)
 
 
 def chunk_files(conn: psycopg.Connection, version: int) -> None:
@@ -401,6 +539,10 @@ def chunk_files(conn: psycopg.Connection, version: int) -> None:
         ).fetchall()
     ]
 
+    # The tmp tables are rebuilt from scratch on every run, so there's no need
+    # to wait for the WAL flush on each per-page commit.
+    conn.execute("set synchronous_commit = off")
+
     conn.execute("drop table if exists docs.postgres_chunks_tmp")
     conn.execute("drop table if exists docs.postgres_pages_tmp")
 
@@ -442,70 +584,50 @@ def chunk_files(conn: psycopg.Connection, version: int) -> None:
     )
     conn.commit()
 
-    header_pattern = re.compile("^(#{1,3}) .+$")
-    codeblock_pattern = re.compile("^```")
-
-    section_prefix = r"^[A-Za-z0-9.]+\.\s*"
-    chapter_prefix = r"^Chapter\s+[0-9]+\.\s*"
-
-    page_count = 0
-
+    # Read every frontmatter up front so that all pages can be inserted with a
+    # single statement.
+    pages: list[tuple[Path, Page, bool]] = []
     for md in MD_DIR.glob("*.md"):
-        print(f"chunking {md}...")
         with md.open() as f:
-            # process the frontmatter
             f.readline()
             f.readline()  # title line
             slug = f.readline().split(":", 1)[1].strip()
             refentry = f.readline().split(":", 1)[1].strip().lower() == "true"
-            f.readline()
+        page = Page(
+            id=0,
+            version=version,
+            url=f"{POSTGRES_BASE_URL}/{version}/{slug}",
+            domain="postgresql.org",
+            filename=md.name,
+        )
+        pages.append((md, page, refentry))
 
-            page = Page(
-                id=0,
-                version=version,
-                url=f"{POSTGRES_BASE_URL}/{version}/{slug}",
-                domain="postgresql.org",
-                filename=md.name,
-            )
-            page_count += 1
+    insert_pages(conn, [page for _, page, _ in pages])
+    conn.commit()
 
-            insert_page(conn, page)
-
-            header_path = []
-            idx = 0
-            chunk: Chunk | None = None
-            in_codeblock = False
-            while True:
-                line = f.readline()
-                if line == "":
-                    if chunk is not None:
-                        process_chunk(conn, page, chunk)
-                    break
-                match = header_pattern.match(line)
-                if match is None or in_codeblock or (refentry and chunk is not None):
-                    assert chunk is not None
-                    if codeblock_pattern.match(line):
-                        in_codeblock = not in_codeblock
-                    chunk.content += line
-                    continue
-                header_hases = match.group(1)
-                depth = len(header_hases)
-                header_path = header_path[: (depth - 1)]
-                header = line.lstrip("#").strip()
-                header = re.sub(section_prefix, "", header).strip()
-                header = re.sub(chapter_prefix, "", header).strip()
-                header_path.append(header)
-                if chunk is not None:
-                    process_chunk(conn, page, chunk)
-                chunk = Chunk(
-                    idx=idx,
-                    header=header,
-                    header_path=header_path.copy(),
-                    content="",
-                )
-                idx += 1
-            update_page_stats(conn, page)
-            conn.commit()
+    page_count = 0
+    # Pages whose embedding requests are still in flight, oldest first. Only
+    # the main thread touches the connection, so pages are saved in order.
+    pending: deque[tuple[Page, list[Future[list[tuple]]]]] = deque()
+
+    with ThreadPoolExecutor(max_workers=EMBEDDING_WORKERS) as executor:
+        for md, page, refentry in pages:
+            print(f"chunking {md}...")
+            page_count += 1
+            page_chunks = read_chunks(md, refentry)
+            embeddings = [
+                executor.submit(embed_chunks, page, batch)
+                for batch in batch_chunks(page_chunks)
+            ]
+            pending.append((page, embeddings))
+            if len(pending) > EMBEDDING_WORKERS:
+                save_page(conn, *pending.popleft())
+        while pending:
+            save_page(conn, *pending.popleft())
+
+    # Swapping the tables is what replaces the live docs, so make that commit
+    # durable again.
+    conn.execute("reset synchronous_commit")
 
     with conn.cursor() as cur:
         cur.execute("drop table docs.postgres_chunks")